@@ -0,0 +1,130 @@
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Measures the fixed cost every PythonShell spawn pays before doing any work:
+# the interpreter startup, the import of the entry point module,
+# and the import of the dependencies its stage loads lazily when it runs.
+# Usage: python benchmarks/startup_time.py [repeats]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# entry point module -> (directory, dependencies imported lazily by its stage)
+ENTRY_POINTS = {
+    "preprocess": (
+        os.path.join(ROOT, "reel-image-preprocessor", "src"),
+        ["easyocr", "PIL.Image", "PIL.ImageFilter", "requests", "Levenshtein"],
+    ),
+    "crop": (os.path.join(ROOT, "reel-image-cropper", "src"), ["cv2"]),
+    "analyze": (os.path.join(ROOT, "reel-image-analyzer", "src"), ["cv2"]),
+    "processor": (os.path.join(ROOT, "reel-image-processor", "src"), ["Levenshtein"]),
+}
+
+
+def time_command(code, cwd, repeats):
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=cwd, check=True)
+        timings.append(time.perf_counter() - start_time)
+    return statistics.median(timings)
+
+
+def slowest_imports(module, cwd, top=5):
+    """
+    This function will list the direct imports of a module with the highest cumulative import time
+    :param module: name of the module to import
+    :param cwd: directory of the module
+    :param top: number of imports to return
+    :return: list of (imported package, cumulative import time in ms)
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # nested imports are listed before their parent and indented by 2 spaces per level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            if name.strip() == module:
+                return sorted(imports, key=lambda x: x[1], reverse=True)[:top]
+            imports = []
+        elif depth == 1:
+            imports.append((name.strip(), int(cumulative) / 1000))
+    return []
+
+
+def lazy_import_time(name, cwd):
+    """
+    This function will measure the cumulative import time of a dependency on its own
+    :param name: name of the dependency
+    :param cwd: directory of the entry point
+    :return: cumulative import time in ms
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {name}"],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    cumulative_time = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, imported = line[len("import time:") :].split("|")
+        # only the top level packages, the nested ones are included in their parent
+        if not imported[1:].startswith(" "):
+            cumulative_time += int(cumulative)
+    return round(cumulative_time / 1000, 1)
+
+
+def main(argv):
+    repeats = int(argv[1]) if len(argv) > 1 else 5
+    interpreter_time = time_command("pass", ROOT, repeats)
+    output = {"interpreterMs": round(interpreter_time * 1000, 1), "entryPoints": {}}
+    for module, (cwd, lazy_imports) in ENTRY_POINTS.items():
+        import_time = time_command(f"import {module}", cwd, repeats)
+        output["entryPoints"][module] = {
+            "startupMs": round(import_time * 1000, 1),
+            "importMs": round((import_time - interpreter_time) * 1000, 1),
+            "slowestImports": slowest_imports(module, cwd),
+        }
+
+        # the stage pays for its lazy imports as soon as it runs
+        installed = [
+            name
+            for name in lazy_imports
+            if importlib.util.find_spec(name.split(".")[0]) is not None
+        ]
+        stage_code = "; ".join(f"import {name}" for name in [module] + installed)
+        stage_time = time_command(stage_code, cwd, repeats)
+        output["entryPoints"][module].update(
+            {
+                "stageStartupMs": round(stage_time * 1000, 1),
+                "lazyImportsMs": round((stage_time - import_time) * 1000, 1),
+                "lazyImports": {
+                    name: lazy_import_time(name, cwd) for name in installed
+                },
+                "missingLazyImports": [
+                    name for name in lazy_imports if name not in installed
+                ],
+            }
+        )
+    print(json.dumps(output, indent=2))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -34,9 +34,12 @@ app.post('/analyze', async (req, res) => {
     try {
         const options = {
             scriptPath: __dirname,
-            args: [reelId],
+            args: [reelId, '--stream'],
         };
         const pyShell = new PythonShell('analyze.py', options);
+        // progress events are forwarded at most every progressIntervalMs, the last one of a stage is always forwarded
+        const progressIntervalMs = 5000;
+        let lastProgressTime = 0;
         // Event listener for when the script starts
         pyShell.on('start', () => {
             console.log('Python script is running.');
@@ -46,26 +49,56 @@ app.post('/analyze', async (req, res) => {
         pyShell.on('message', (message) => {
             // console.log('Python script says:', message);
             const output = message;
+            let parsedOutput = null;
+            try {
+                parsedOutput = JSON.parse(output);
+            } catch (error) {
+                console.log('Python script says:', output);
+                return;
+            }
+            // progress events are streamed before the final output
+            if (parsedOutput.event) {
+                if (parsedOutput.event === 'progress' && parsedOutput.framesDone < parsedOutput.totalFrames &&
+                    Date.now() - lastProgressTime < progressIntervalMs) {
+                    return;
+                }
+                if (parsedOutput.event === 'progress') {
+                    lastProgressTime = Date.now();
+                }
+                const progressMessage = {
+                    'reelId': reelId,
+                    'event': {
+                        'type': 'analyzer',
+                        'status': 'progress',
+                        'message': output
+                    }
+                };
+                awsFunctions.sendMessageToSQS(JSON.stringify(progressMessage), queueUrl, 'sendMessageToSQS');
+                return;
+            }
             console.log('message start');
             console.log(output);
             console.log('message end');
         });
 
         // TODO: update to analyzed for images
+        // the stage is complete once the script ends, after its last progress event
         pyShell.end((err) => {
             if (err) {
                 console.error(`Error: ${err}`);
+                message.event.status = 'error';
+                message.event.message = JSON.stringify(err.toString());
+                awsFunctions.sendMessageToSQS(JSON.stringify(message), queueUrl, 'sendMessageToSQS');
                 res.status(500).send(err);
                 return;
             } else {
                 console.log('Python shell ended successfully');
+                message.event.status = 'complete';
+                awsFunctions.sendMessageToSQS(JSON.stringify(message), queueUrl, 'sendMessageToSQS');
                 res.send('Python script invoked.');
                 return;
             }
         });
-        // Send an immediate response to the client
-        message.event.status = 'complete';
-        awsFunctions.sendMessageToSQS(JSON.stringify(message), queueUrl, 'sendMessageToSQS');
     } catch (error) {
         message.event.status = 'error';
         message.event.message = JSON.stringify(error);
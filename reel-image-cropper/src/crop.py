@@ -0,0 +1,187 @@
+import json
+import math
+import os
+import sys
+import numpy as np
+
+# cv2 is imported where it is used so that a stage only pays for the dependencies it needs
+
+
+class RotatedCrop:
+    """
+    Crops an area of an image after rotating it, without rotating the whole image.
+    The crop area is given in the coordinates of the rotated image, the same way the golden sample is defined:
+    the image is rotated by -rotation degrees counter-clockwise around its center onto a canvas large enough to hold it,
+    then cropped. Only the region of the source image under the crop area is warped.
+    """
+
+    def __init__(self, crop_area, rotation=0):
+        # jimp rounded the crop area, half up like Math.round, and the size of the crop must be an integer
+        self.x, self.y, self.width, self.height = [
+            math.floor(crop_area[key] + 0.5) for key in ("x", "y", "width", "height")
+        ]
+        # the golden sample rotation is applied the other way around
+        self.angle = -rotation
+
+    def rotated_size(self, width, height):
+        """
+        This function will compute the size of the canvas holding the rotated image
+        :param width: width of the source image
+        :param height: height of the source image
+        :return: width, height of the rotated image
+        """
+        if self.angle % 90 == 0:
+            if self.angle % 180 == 0:
+                return width, height
+            return height, width
+
+        rad = math.radians(self.angle % 360)
+        cosine = abs(math.cos(rad))
+        sine = abs(math.sin(rad))
+        # same canvas as jimp: rounded up, with a 1 pixel border, to an even size
+        rotated_width = math.ceil(width * cosine + height * sine) + 1
+        rotated_height = math.ceil(width * sine + height * cosine) + 1
+        return rotated_width + rotated_width % 2, rotated_height + rotated_height % 2
+
+    def source_transform(self, width, height):
+        """
+        This function will compute the affine transform from the pixels of the crop to the pixels of the source image
+        :param width: width of the source image
+        :param height: height of the source image
+        :return: 2x3 matrix
+        """
+        rotated_width, rotated_height = self.rotated_size(width, height)
+        rad = math.radians(self.angle)
+        cosine = math.cos(rad)
+        sine = math.sin(rad)
+        rotation = np.array([[cosine, -sine], [sine, cosine]])
+
+        # the rotation is around the pixel centers of both images
+        crop_origin = np.array(
+            [
+                self.x + 0.5 - rotated_width / 2,
+                self.y + 0.5 - rotated_height / 2,
+            ]
+        )
+        translation = rotation @ crop_origin + np.array([width / 2, height / 2]) - 0.5
+        return np.hstack([rotation, translation[:, None]])
+
+    def source_region(self, width, height):
+        """
+        This function will compute the region of the source image needed by the crop
+        :param width: width of the source image
+        :param height: height of the source image
+        :return: x_min, x_max, y_min, y_max of the region, clipped to the image
+        """
+        transform = self.source_transform(width, height)
+        corners = np.array(
+            [
+                [0, 0, 1],
+                [self.width - 1, 0, 1],
+                [0, self.height - 1, 1],
+                [self.width - 1, self.height - 1, 1],
+            ]
+        )
+        source_corners = corners @ transform.T
+        # 1 pixel margin for the interpolation
+        x_min = max(0, math.floor(source_corners[:, 0].min()) - 1)
+        x_max = min(width, math.ceil(source_corners[:, 0].max()) + 2)
+        y_min = max(0, math.floor(source_corners[:, 1].min()) - 1)
+        y_max = min(height, math.ceil(source_corners[:, 1].max()) + 2)
+        return x_min, x_max, y_min, y_max
+
+    def run(self, image):
+        """
+        This function will rotate and crop the image
+        :param image: image as a numpy array
+        :return: cropped image
+        """
+        import cv2
+
+        height, width = image.shape[:2]
+        x_min, x_max, y_min, y_max = self.source_region(width, height)
+        if x_max <= x_min or y_max <= y_min:
+            # the crop area is outside of the image
+            return np.zeros((self.height, self.width) + image.shape[2:], image.dtype)
+
+        transform = self.source_transform(width, height)
+        transform[:, 2] -= [x_min, y_min]
+        # rotations by a multiple of 90 degrees map pixels onto pixels
+        interpolation = cv2.INTER_NEAREST if self.angle % 90 == 0 else cv2.INTER_LINEAR
+        return cv2.warpAffine(
+            image[y_min:y_max, x_min:x_max],
+            transform,
+            (self.width, self.height),
+            flags=interpolation | cv2.WARP_INVERSE_MAP,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=0,
+        )
+
+
+def main(argv):
+    import cv2
+
+    # Some kind of hardcoded path
+
+    directory = "/Users/clarkfan/Desktop/test_image/" + argv[1]
+
+    output_directory = directory + "_output"
+
+    output_with_pin_directory = directory + "_output_with_pin"
+
+    golden_sample = json.loads(argv[2])
+
+    golden_sample_with_pin = json.loads(argv[3])
+
+    os.makedirs(output_directory, exist_ok=True)
+    os.makedirs(output_with_pin_directory, exist_ok=True)
+
+    image_files = [
+        filename
+        for filename in os.listdir(directory)
+        if filename.endswith((".jpg", ".jpeg", ".png", ".bmp"))
+    ]
+
+    # Sort the image files in ascending order based on their names
+    sorted_image_files = sorted(image_files)
+    has_error = False
+    saved_exception = None
+    last_successful_image = None
+    processed_images = []
+    # Iterate over the sorted image files
+    try:
+        crop = RotatedCrop(golden_sample["cropArea"], golden_sample["rotation"])
+        crop_with_pin = RotatedCrop(
+            golden_sample_with_pin["cropArea"], golden_sample_with_pin["rotation"]
+        )
+        for filename in sorted_image_files:
+            # the image is decoded once for both crops
+            img = cv2.imread(os.path.join(directory, filename))
+
+            cv2.imwrite(os.path.join(output_directory, filename), crop.run(img))
+
+            with_pin_filename = os.path.splitext(filename)[0] + ".webp"
+            cv2.imwrite(
+                os.path.join(output_with_pin_directory, with_pin_filename),
+                crop_with_pin.run(img),
+                [cv2.IMWRITE_WEBP_QUALITY, 50],
+            )
+            processed_images.append(filename)
+            last_successful_image = filename
+    except Exception as e:
+        has_error = True
+        saved_exception = e
+        pass
+
+    output = {
+        "processedImages": processed_images,
+        "hasError": has_error,
+        "lastSuccessfulImage": last_successful_image,
+    }
+    print(json.dumps(output))
+    if has_error:
+        raise saved_exception
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,7 +1,5 @@
 const express = require('express');
-const jimp = require('jimp');
-const fs = require('fs');
-const path = require('path');
+const {PythonShell} = require('python-shell');
 const conn = require('./application/connection.js');
 const mongoose = require('mongoose');
 const awsFunctions = require('../../common-components/aws/aws');
@@ -43,102 +41,85 @@ app.post('/crop', async (req, res) => {
             } else {
                 // can find reel info based on reelId
                 res.send({'success': true});
-                const inputPath = fixedPath + reelId;
                 const outputPath = fixedPath + reelId + '_output';
-                const outputPathWithPin = fixedPath + reelId + '_output_with_pin';
 
-                const cropX = reel.goldenSampleData.cropArea.x; // X-coordinate of the top-left corner
-                const cropY = reel.goldenSampleData.cropArea.y; // Y-coordinate of the top-left corner
-                const cropWidth = reel.goldenSampleData.cropArea.width; // Width of the cropped area
-                const cropHeight = reel.goldenSampleData.cropArea.height; // Height of the cropped area
-
-                const cropXWithPin = reel.goldenSampleDataWithPin.cropArea.x; // X-coordinate of the top-left corner
-                const cropYWithPin = reel.goldenSampleDataWithPin.cropArea.y; // Y-coordinate of the top-left corner
-                const cropWidthWithPin = reel.goldenSampleDataWithPin.cropArea.width; // Width of the cropped area
-                const cropHeightWithPin = reel.goldenSampleDataWithPin.cropArea.height; // Height of the cropped area
-
-
-                let rotationAngle = reel.goldenSampleData.rotation;
-                let rotationAngleWithPin = reel.goldenSampleDataWithPin.rotation;
-
-                rotationAngle = -rotationAngle;
-                rotationAngleWithPin = -rotationAngleWithPin;
-                // Create the output directory if it doesn't exist
-                if (!fs.existsSync(outputPath)) {
-                    fs.mkdirSync(outputPath, {recursive: true});
-                }
-
-                // Create the output with pin directory if it doesn't exist
-                if (!fs.existsSync(outputPathWithPin)) {
-                    fs.mkdirSync(outputPathWithPin, {recursive: true});
-                }
-
-                // Read the files in the input directory
-                const files = fs.readdirSync(inputPath);
-                files.sort((a, b) => a.localeCompare(b));
-                const imagesToUpload = [];
-                const webpExtension = '.webp';
-                for (const file of files) {
-                    if (!(file.endsWith('.jpg') || file.endsWith('.jpeg') || file.endsWith('.png') || file.endsWith('.bmp'))) {
-                        continue;
-                    }
-                    const inputFilePath = path.join(inputPath, file);
-                    const outputFilePath = path.join(outputPath, file);
-                    const outputWithPinFilePath = path.join(outputPathWithPin, path.basename(file, path.extname(file)) + webpExtension);
-                    const image = await jimp.read(inputFilePath);
-                    // Apply the crop and rotation operations
-                    image
-                        .rotate(rotationAngle)
-                        .crop(cropX, cropY, cropWidth, cropHeight)
-                        .write(outputFilePath);
-
-                    // TODO: check on how to correctly compress to webp since currently file size stays the same
-
-                    jimp.read(inputFilePath).then((img) => {
-                        return img
-                            .rotate(rotationAngleWithPin)
-                            .crop(cropXWithPin, cropYWithPin, cropWidthWithPin, cropHeightWithPin)
-                            .quality(50)
-                            .write(outputWithPinFilePath);
+                // The python cropper rotates and crops only the region under each crop area,
+                // and writes both the crop and the crop with pin from a single decode of every image
+                const options = {
+                    scriptPath: __dirname,
+                    args: [reelId, JSON.stringify(reel.goldenSampleData), JSON.stringify(reel.goldenSampleDataWithPin)],
+                };
+                try {
+                    // the script prints what it processed even when a frame fails, so it is kept along with the error
+                    const {output, pyError} = await new Promise((resolve) => {
+                        let outputFromPy = null;
+                        const pyShell = new PythonShell('crop.py', options);
+                        pyShell.on('message', (messageFromPy) => {
+                            try {
+                                outputFromPy = JSON.parse(messageFromPy);
+                            } catch (parseError) {
+                                console.log('Python script says:', messageFromPy);
+                            }
+                        });
+                        pyShell.end((err) => {
+                            resolve({output: outputFromPy, pyError: err});
+                        });
                     });
 
-                    const tempImage = new Image(reelId, outputPath, file);
-                    lastSuccessfulImage = file;
-                    imagesToUpload.push(tempImage);
-                    allProcessedImages.push(file);
-                }
-
-                // Create an array of update operations
-                const bulkOperations = imagesToUpload.map((document) => ({
-                    updateOne: {
-                        filter: {'reelId': document.reelId, 'file.name': document.file.name},
-                        update: {$set: document},
-                        upsert: true
+                    const imagesToUpload = [];
+                    if (output) {
+                        for (const file of output.processedImages) {
+                            const tempImage = new Image(reelId, outputPath, file);
+                            imagesToUpload.push(tempImage);
+                            allProcessedImages.push(file);
+                        }
+                        lastSuccessfulImage = output.lastSuccessfulImage;
                     }
-                }));
 
-                // Perform upsert operation
-                await db.collection('ops_ai_image').bulkWrite(bulkOperations);
+                    // Create an array of update operations
+                    const bulkOperations = imagesToUpload.map((document) => ({
+                        updateOne: {
+                            filter: {'reelId': document.reelId, 'file.name': document.file.name},
+                            update: {$set: document},
+                            upsert: true
+                        }
+                    }));
+
+                    // Perform upsert operation
+                    if (bulkOperations.length > 0) {
+                        await db.collection('ops_ai_image').bulkWrite(bulkOperations);
+                    }
 
-                const reelDataToUpdate = {
-                    'status': 'crop-complete',
-                    'images': allProcessedImages,
-                    'lastSuccessfulImage': lastSuccessfulImage
-                };
-                const reelUpdate = await db.collection('ops_ai_reel').updateOne(
-                    {_id: new ObjectId(reelId)},
-                    {$set: reelDataToUpdate}
-                );
+                    const reelDataToUpdate = {
+                        'status': pyError ? 'crop-error' : 'crop-complete',
+                        'images': allProcessedImages,
+                        'lastSuccessfulImage': lastSuccessfulImage
+                    };
+                    const reelUpdate = await db.collection('ops_ai_reel').updateOne(
+                        {_id: new ObjectId(reelId)},
+                        {$set: reelDataToUpdate}
+                    );
+
+                    if (reelUpdate.modifiedCount > 0) {
+                        console.log(`Reel with _id ${reelId} updated successfully`);
+                    } else {
+                        console.log(`No Reel found with _id ${reelId}`);
+                    }
 
-                if (reelUpdate.modifiedCount > 0) {
-                    console.log(`Reel with _id ${reelId} updated successfully`);
-                } else {
-                    console.log(`No Reel found with _id ${reelId}`);
+                    if (pyError) {
+                        throw pyError;
+                    }
+                    message.event.status = 'complete';
+                    awsFunctions.sendMessageToSQS(JSON.stringify(message), queueUrl, sendMessageToSQS);
+                } catch (error) {
+                    console.error('Error processing images:', error);
+                    message.event.status = 'error';
+                    message.event.message = JSON.stringify(error.toString());
+                    message.event.lastSuccessfulImage = lastSuccessfulImage;
+                    awsFunctions.sendMessageToSQS(JSON.stringify(message), queueUrl, sendMessageToSQS);
                 }
             }
         });
-        message.event.status = 'complete';
-        awsFunctions.sendMessageToSQS(JSON.stringify(message), queueUrl, sendMessageToSQS);
     } catch (error) {
         console.error('Error processing images:', error);
         res.status(500).send('Internal Server Error');
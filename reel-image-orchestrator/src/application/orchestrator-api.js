@@ -93,8 +93,15 @@ module.exports = {
                             } else if (reel.event.status != null && reel.event.status === 'error') {
                                 await pushNotifications(reelInfo);
                                 await pushEventSocket(reelInfo);
+                            } else if (reel.event.status != null && reel.event.status === 'progress') {
+                                // progress streamed by the python scripts while a stage runs.
+                                // It is only pushed to the socket: the SQS messages are not ordered,
+                                // so writing it to the reel could overwrite a later status
+                                await pushEventSocket(reelInfo);
+                            }
+                            if (reel.event.status !== 'progress') {
+                                await updateReel(reelInfo);
                             }
-                            await updateReel(reelInfo);
                             console.log(reelInfo);
                             if (start) {
                                 reelInfo = await processReelOnType(reelInfo, reelInfo.event.type);
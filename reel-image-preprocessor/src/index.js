@@ -36,10 +36,13 @@ app.post('/preprocess', async (req, res) => {
         const goldenSampleData = reelData.goldenSampleData;
         const options = {
             scriptPath: __dirname,
-            args: [reelId, JSON.stringify(goldenSampleData)],
+            args: [reelId, JSON.stringify(goldenSampleData), '--stream'],
         };
         const pyShell = new PythonShell('preprocess.py', options);
         res.send('Python script invoked.');
+        // progress events are forwarded at most every progressIntervalMs, the last one of a stage is always forwarded
+        const progressIntervalMs = 5000;
+        let lastProgressTime = 0;
         // Event listener for when the script starts
         pyShell.on('start', () => {
             console.log('Python script is running.');
@@ -49,7 +52,34 @@ app.post('/preprocess', async (req, res) => {
         pyShell.on('message', (messageFromPy) => {
             // console.log('Python script says:', message);
             const output = messageFromPy;
-            errPct = JSON.parse(output).anomalyPct;
+            let parsedOutput = null;
+            try {
+                parsedOutput = JSON.parse(output);
+            } catch (error) {
+                console.log('Python script says:', output);
+                return;
+            }
+            // progress events are streamed before the final output
+            if (parsedOutput.event) {
+                if (parsedOutput.event === 'progress' && parsedOutput.framesDone < parsedOutput.totalFrames &&
+                    Date.now() - lastProgressTime < progressIntervalMs) {
+                    return;
+                }
+                if (parsedOutput.event === 'progress') {
+                    lastProgressTime = Date.now();
+                }
+                const progressMessage = {
+                    'reelId': reelId,
+                    'event': {
+                        'type': 'preprocess',
+                        'status': 'progress',
+                        'message': output
+                    }
+                };
+                awsFunctions.sendMessageToSQS(JSON.stringify(progressMessage), queueUrl, 'sendMessageToSQS');
+                return;
+            }
+            errPct = parsedOutput.anomalyPct;
             message.event.message = output;
         });
 
@@ -1,16 +1,15 @@
 import json
 import os
 import sys
-import requests
 from io import BytesIO
-from PIL import ImageFilter, Image
 import numpy as np
-import easyocr
 import collections
-import Levenshtein
 import time
 import shutil
 
+# easyocr (and torch with it), requests, PIL and Levenshtein are imported where they are used
+# so that a stage only pays for the dependencies it needs
+
 
 class ImagePreprocessor:
     def __init__(
@@ -19,25 +18,34 @@ class ImagePreprocessor:
         use_binarization_threshold=0,
         is_local=True,
         verbose=False,
+        crop_area=None,
     ):
         # initializing the variables we'll need to process the images. The highly depends on the reel.
+        self.crop_area = crop_area
         self.use_filter = use_filter
         self.use_binarization_threshold = use_binarization_threshold
         self.is_local = is_local
         self.verbose = verbose
 
     def open_image_hosted(self, url):
+        import requests
+        from PIL import Image
+
         response = requests.get(url)
         image = Image.open(BytesIO(response.content))
         return image
 
     def open_image_local(self, path):
+        from PIL import Image
+
         image = Image.open(path)
         return image
 
     def preprocess(self, image):
+        from PIL import ImageFilter
+
         if self.verbose:
-            print("Processing image shape: ", image.size)
+            print("Processing image shape: ", image.size, file=sys.stderr)
 
         if self.use_filter:
             image = image.filter(ImageFilter.MinFilter(3))
@@ -46,7 +54,7 @@ class ImagePreprocessor:
             image = image.point(lambda p: p > self.use_binarization_threshold and 255)
 
         if self.verbose:
-            print("Processed image shape: ", image.size)
+            print("Processed image shape: ", image.size, file=sys.stderr)
 
         return image
 
@@ -63,13 +71,115 @@ class ImagePreprocessor:
             image = self.open_image_local(image_path)
         else:
             image = self.open_image_hosted(image_path)
-        image = image.crop((x, y, x + width, y + height))
+        if self.crop_area:
+            x = self.crop_area["x"]
+            y = self.crop_area["y"]
+            width = self.crop_area["width"]
+            height = self.crop_area["height"]
+            image = image.crop((x, y, x + width, y + height))
         image = self.preprocess(image)
         return np.array(image)
 
 
+def peak_rss_mb():
+    import resource
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on linux
+    if sys.platform == "darwin":
+        return peak_rss / (1024 * 1024)
+    return peak_rss / 1024
+
+
+def physical_memory_mb():
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / (1024 * 1024)
+
+
+class BatchSizeTuner:
+    """
+    Picks the OCR batch size from the throughput and memory measured on the first batches of a reel.
+    Every candidate batch size is probed once, in increasing order, and the fastest one whose memory usage stays
+    under the memory limit is kept. The probing starts over if the throughput degrades later in the reel.
+    """
+
+    def __init__(
+        self,
+        candidate_batch_sizes=(2, 4, 8, 16, 32, 64),
+        memory_limit_mb=None,
+        degradation_ratio=0.7,
+        smoothing=0.3,
+    ):
+        """
+        :param candidate_batch_sizes: batch sizes to probe
+        :param memory_limit_mb: maximum memory the OCR can use on top of what was used before the first batch, defaults to half of the physical memory
+        :param degradation_ratio: the batch sizes are probed again when the throughput drops under this ratio of the probed throughput
+        :param smoothing: weight of the last batch in the running average of the throughput
+        """
+        self.candidate_batch_sizes = sorted(candidate_batch_sizes)
+        if memory_limit_mb is None:
+            memory_limit_mb = physical_memory_mb() / 2
+        self.memory_limit_mb = memory_limit_mb
+        self.degradation_ratio = degradation_ratio
+        self.smoothing = smoothing
+
+        self.baseline_rss_mb = peak_rss_mb()
+        self.memory_usage_mb = {}  # batch size -> memory used when running it
+        self.throughput = {}  # batch size -> images per second measured while probing
+        self.allowed_batch_sizes = list(self.candidate_batch_sizes)
+        self.batch_sizes_to_probe = list(self.candidate_batch_sizes)
+        self.batch_size = None
+        self.average_throughput = None
+        self.batch_start_time = None
+
+    def next_batch_size(self):
+        if self.batch_sizes_to_probe:
+            return self.batch_sizes_to_probe[0]
+        return self.batch_size
+
+    def start_batch(self):
+        self.batch_start_time = time.perf_counter()
+
+    def end_batch(self, number_images):
+        """
+        This function will record the measures of the batch that just ran and update the batch size
+        :param number_images: number of images in the batch
+        """
+        elapsed_time = max(time.perf_counter() - self.batch_start_time, 1e-9)
+        throughput = number_images / elapsed_time
+
+        if not self.batch_sizes_to_probe:
+            self.average_throughput = (
+                self.smoothing * throughput
+                + (1 - self.smoothing) * self.average_throughput
+            )
+            probed_throughput = self.throughput[self.batch_size]
+            if self.average_throughput < self.degradation_ratio * probed_throughput:
+                self.throughput = {}
+                self.batch_sizes_to_probe = list(self.allowed_batch_sizes)
+            return
+
+        batch_size = self.batch_sizes_to_probe.pop(0)
+        # the peak memory only grows, so it is measured the first time a batch size runs, in increasing order
+        if batch_size not in self.memory_usage_mb:
+            self.memory_usage_mb[batch_size] = peak_rss_mb() - self.baseline_rss_mb
+            if self.memory_usage_mb[batch_size] > self.memory_limit_mb:
+                # larger batches would not fit either
+                self.allowed_batch_sizes = [
+                    b for b in self.allowed_batch_sizes if b < batch_size
+                ] or self.candidate_batch_sizes[:1]
+                self.batch_sizes_to_probe = []
+        if batch_size in self.allowed_batch_sizes:
+            self.throughput[batch_size] = throughput
+
+        if not self.batch_sizes_to_probe:
+            self.batch_size = max(self.throughput, key=self.throughput.get)
+            self.average_throughput = self.throughput[self.batch_size]
+
+
 class ImageOCRProcessor:
     def __init__(self):
+        import easyocr
+
         self.reader = easyocr.Reader(
             ["en"]
         )  # this needs to run only once to load the model into memory
@@ -84,28 +194,516 @@ class ImageOCRProcessor:
         text = self.reader.readtext(image)
         return text
 
-    def run_batch(self, images, batch_size=8, preprocessor=None):
+    def learn_word_regions(self, images):
+        """
+        This function will run the text detection on a few sample images to learn where the words are.
+        The crop area is fixed for a reel, so the word layout is the same on every frame
+
+        :param images: list of processed images
+        :return: list of word regions in the easyocr format [x_min, x_max, y_min, y_max], or None if no layout could be learned
+        """
+        all_regions = []
+        for image in images:
+            horizontal_list, free_list = self.reader.detect(image)
+            # rotated text cannot be described by a horizontal region
+            if len(free_list[0]) > 0 or len(horizontal_list[0]) == 0:
+                continue
+            all_regions.append(horizontal_list[0])
+
+        if len(all_regions) == 0:
+            return None
+
+        # only keep the frames with the most frequent number of words, the same way the clustering does
+        number_words = collections.Counter([len(regions) for regions in all_regions])
+        most_frequent_number_word = number_words.most_common(1)[0][0]
+        all_regions = [
+            regions
+            for regions in all_regions
+            if len(regions) == most_frequent_number_word
+        ]
+        average_regions = np.mean(all_regions, axis=0)
+        return [[int(round(v)) for v in region] for region in average_regions]
+
+    def run_recognition_only(self, images, word_regions):
+        """
+        This function will run the OCR recognition on the given word regions of a batch of images, skipping the text detection.
+        The images are stacked on top of each other so that easyocr recognizes the regions of every image in one batch
+
+        :param images: list of images of the same size
+        :param word_regions: list of word regions returned by learn_word_regions
+        :return: list of OCR outputs of the shape [](bbox, text, confidence), one per image
+        """
+        if any(image.shape != images[0].shape for image in images):
+            return [
+                self.run_recognition_only([image], word_regions)[0] for image in images
+            ]
+
+        height, width = images[0].shape[:2]
+        horizontal_list = []
+        for i in range(len(images)):
+            for x_min, x_max, y_min, y_max in word_regions:
+                # a region must not overlap the next image of the stack
+                horizontal_list.append(
+                    [
+                        max(0, x_min),
+                        min(width, x_max),
+                        max(0, y_min) + i * height,
+                        min(height, y_max) + i * height,
+                    ]
+                )
+        ocr_out = self.reader.recognize(
+            np.concatenate(images, axis=0),
+            horizontal_list=horizontal_list,
+            free_list=[],
+            batch_size=len(horizontal_list),
+        )
+
+        ocr_outputs = [[] for _ in images]
+        for bbox, text, confidence in ocr_out:
+            i = int(bbox[0][1]) // height
+            bbox = [[x, y - i * height] for x, y in bbox]
+            ocr_outputs[i].append((bbox, text, confidence))
+        return ocr_outputs
+
+    def has_word_layout(self, image, word_regions, tolerance=25):
+        """
+        This function will run the text detection on an image and check that it finds the learned word regions
+
+        :param image: image
+        :param word_regions: list of word regions returned by learn_word_regions
+        :param tolerance: maximum difference in pixels between a detected region and the learned one
+        :return: True if the image has the same word layout
+        """
+        horizontal_list, free_list = self.reader.detect(image)
+        if len(free_list[0]) > 0 or len(horizontal_list[0]) != len(word_regions):
+            return False
+        difference = np.abs(np.array(horizontal_list[0]) - np.array(word_regions))
+        return difference.max() <= tolerance
+
+    def run_batch_fixed_regions(
+        self,
+        images,
+        batch_size=8,
+        preprocessor=None,
+        region_learning_frames=8,
+        min_confidence=0.3,
+        verify_interval=10,
+        layout_tolerance=25,
+        autotune=False,
+        memory_limit_mb=None,
+        progress_callback=None,
+    ):
+        """
+        This function will run the OCR pipeline using the word regions learned on the first frames.
+        Frames whose recognition confidence collapses go back through the full pipeline, and so do the sampled frames
+        where the text detection does not find the learned layout.
+        Every other frame gets the learned regions as bounding boxes, so a shifted, missing or extra word recognized with
+        a good confidence is only caught on the sampled frames: the erroneous_bbox and erroneous_number_of_words anomalies
+        of the clustering are mostly disabled in this mode
+
+        :param images: list of processed images or path to images. The latter case will need a preprocessor
+        :param batch_size: number of frames recognized together, ignored when autotune is True
+        :param preprocessor: preprocessor to be used if the images are path to images. Needs to implement a run method path:string -> image:bytes
+        :param region_learning_frames: number of frames used to learn the word regions
+        :param min_confidence: average confidence under which a frame is run through the full pipeline
+        :param verify_interval: the text detection is run on every verify_interval-th frame to check the layout, 0 to never check
+        :param layout_tolerance: maximum difference in pixels between a detected region and the learned one
+        :param autotune: if True, the number of frames recognized together is picked from the throughput and memory measured on the reel, see BatchSizeTuner
+        :param memory_limit_mb: memory limit of the batch size tuner
+        :param progress_callback: function called after every batch, see run_batch
+        :return: OCRResults, or None if no word layout could be learned
+        """
+        learning_images = images[:region_learning_frames]
+        if preprocessor:
+            learning_images = [preprocessor.run(image) for image in learning_images]
+        word_regions = self.learn_word_regions(learning_images)
+        if word_regions is None:
+            return None
+
+        # created after the learning so that the memory used by the text detection is not counted against the batches
+        tuner = BatchSizeTuner(memory_limit_mb=memory_limit_mb) if autotune else None
+        ocr_output_list = OCRResults()
+        start = 0
+        while start < len(images):
+            if tuner:
+                batch_size = tuner.next_batch_size()
+            batch_start_time = time.perf_counter()
+            end = min(start + batch_size, len(images))
+            batch = []
+            for i in range(start, end):
+                if i < len(learning_images):
+                    batch.append(learning_images[i])
+                elif preprocessor:
+                    batch.append(preprocessor.run(images[i]))
+                else:
+                    batch.append(images[i])
+
+            if tuner:
+                tuner.start_batch()
+            batch_out = self.run_recognition_only(batch, word_regions)
+            if tuner:
+                # the frames sent back through the full pipeline are not counted in the throughput
+                tuner.end_batch(len(batch))
+            for i, image, ocr_out in zip(range(start, end), batch, batch_out):
+                confidences = [confidence for _, _, confidence in ocr_out]
+                if len(confidences) == 0 or np.mean(confidences) < min_confidence:
+                    ocr_out = self.run(image)
+                elif (
+                    verify_interval
+                    and i % verify_interval == 0
+                    and not self.has_word_layout(image, word_regions, layout_tolerance)
+                ):
+                    ocr_out = self.run(image)
+                ocr_output_list.append(ocr_out)
+            start = end
+
+            if progress_callback:
+                progress_callback(
+                    start, len(batch), time.perf_counter() - batch_start_time
+                )
+
+        return ocr_output_list
+
+    def run_batch(
+        self,
+        images,
+        batch_size=8,
+        preprocessor=None,
+        use_fixed_regions=False,
+        region_learning_frames=8,
+        min_confidence=0.3,
+        verify_interval=10,
+        layout_tolerance=25,
+        autotune=False,
+        memory_limit_mb=None,
+        progress_callback=None,
+    ):
         """
         This function will run the OCR pipeline
 
         :param images: list of processed images or path to images. The latter case will need a preprocessor
-        :param batch_size: batch size
+        :param batch_size: batch size, ignored when autotune is True. When use_fixed_regions is True, number of frames recognized together
         :param preprocessor: preprocessor to be used if the images are path to images. Needs to implement a run method path:string -> image:bytes
-        :return: list of OCR outputs of the shape [](bbox, text, confidence)
+        :param use_fixed_regions: if True, the text detection only runs on the first frames and on a sample of the reel, the other frames are only recognized, see run_batch_fixed_regions
+        :param region_learning_frames: number of frames used to learn the word regions when use_fixed_regions is True
+        :param min_confidence: average confidence under which a frame is run through the full pipeline when use_fixed_regions is True
+        :param verify_interval: the text detection is run on every verify_interval-th frame to check the layout when use_fixed_regions is True, 0 to never check
+        :param layout_tolerance: maximum difference in pixels between a detected region and the learned one when use_fixed_regions is True
+        :param autotune: if True, the batch size is picked from the throughput and memory measured on the reel, see BatchSizeTuner.
+            It also applies to the recognition of the fixed regions, and the tuner starts over if the reel falls back to the full pipeline
+        :param memory_limit_mb: memory limit of the batch size tuner
+        :param progress_callback: function called after every batch with the number of frames done, the number of frames in the batch and the batch time in seconds
+        :return: OCRResults
         """
-        ocr_output_list = []
-        for i in range(0, len(images) // batch_size + 1):
-            batch = images[i * batch_size : (i + 1) * batch_size]
+        if use_fixed_regions:
+            ocr_output_list = self.run_batch_fixed_regions(
+                images,
+                batch_size=batch_size,
+                preprocessor=preprocessor,
+                region_learning_frames=region_learning_frames,
+                min_confidence=min_confidence,
+                verify_interval=verify_interval,
+                layout_tolerance=layout_tolerance,
+                autotune=autotune,
+                memory_limit_mb=memory_limit_mb,
+                progress_callback=progress_callback,
+            )
+            if ocr_output_list is not None:
+                return ocr_output_list
+
+        tuner = BatchSizeTuner(memory_limit_mb=memory_limit_mb) if autotune else None
+        ocr_output_list = OCRResults()
+        start = 0
+        while start < len(images):
+            if tuner:
+                batch_size = tuner.next_batch_size()
+            batch = images[start : start + batch_size]
+            start += len(batch)
+            batch_start_time = time.perf_counter()
             if preprocessor:
                 batch = [preprocessor.run(image) for image in batch]
 
+            if tuner:
+                tuner.start_batch()
             batch_out = self.reader.readtext_batched(batch)
+            if tuner:
+                tuner.end_batch(len(batch))
             for ocr_out in batch_out:
                 ocr_output_list.append(ocr_out)
 
+            if progress_callback:
+                progress_callback(
+                    start, len(batch), time.perf_counter() - batch_start_time
+                )
+
         return ocr_output_list
 
 
+class OCRResults:
+    """
+    Compact storage for the OCR results of a reel.
+    Instead of one python object per vertex coordinate, the words of all the images are stored in contiguous arrays:
+        vertices: bounding box of every word, shape (number of words, 4, 2)
+        confidences: OCR confidence of every word, shape (number of words,)
+        text_ids: index of the text of every word in the texts table, shape (number of words,)
+        offsets: index of the first word of every image, shape (number of images + 1,)
+    The word at index k of the image i is stored at offsets[i] + k
+    """
+
+    def __init__(self, capacity=1024):
+        self.texts = []  # interned string table
+        self.text_index = {}
+        self._vertices = np.zeros((capacity, 4, 2), dtype=np.float32)
+        self._confidences = np.zeros(capacity, dtype=np.float32)
+        self._text_ids = np.zeros(capacity, dtype=np.int32)
+        self._offsets = np.zeros(capacity + 1, dtype=np.int64)
+        self._number_words = 0
+        self._number_images = 0
+
+    @classmethod
+    def from_list(cls, ocr_results):
+        """
+        This function will build the compact storage from a list of ocr results
+        :param ocr_results: list of ocr results of the shape [][](bbox, text, confidence)
+        :return: OCRResults
+        """
+        number_words = sum(len(ocr_data) for ocr_data in ocr_results)
+        results = cls(capacity=max(1, number_words, len(ocr_results)))
+        results.extend(ocr_results)
+        return results
+
+    def intern_text(self, text):
+        text_id = self.text_index.get(text)
+        if text_id is None:
+            text_id = len(self.texts)
+            self.text_index[text] = text_id
+            self.texts.append(text)
+        return text_id
+
+    def _grow(self, array, size):
+        # doubling the capacity keeps the appends amortized O(1)
+        capacity = len(array)
+        if size <= capacity:
+            return array
+        while capacity < size:
+            capacity *= 2
+        grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+        grown[: len(array)] = array
+        return grown
+
+    def append(self, ocr_data):
+        """
+        This function will add the ocr result of one image
+        :param ocr_data: list of ocr outputs of the shape [](bbox, text, confidence)
+        """
+        start = self._number_words
+        end = start + len(ocr_data)
+        self._vertices = self._grow(self._vertices, end)
+        self._confidences = self._grow(self._confidences, end)
+        self._text_ids = self._grow(self._text_ids, end)
+        self._offsets = self._grow(self._offsets, self._number_images + 2)
+
+        for position, (bbox, text, confidence) in enumerate(ocr_data, start):
+            self._vertices[position] = bbox
+            self._confidences[position] = confidence
+            self._text_ids[position] = self.intern_text(text)
+        self._number_words = end
+        self._number_images += 1
+        self._offsets[self._number_images] = end
+
+    def extend(self, ocr_results):
+        for ocr_data in ocr_results:
+            self.append(ocr_data)
+
+    def __len__(self):
+        return self._number_images
+
+    def __getitem__(self, i):
+        """
+        :return: ocr result of the image i in the shape [](bbox, text, confidence)
+        """
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return [
+            (
+                self._vertices[position],
+                self.texts[self._text_ids[position]],
+                float(self._confidences[position]),
+            )
+            for position in range(start, end)
+        ]
+
+    @property
+    def vertices(self):
+        return self._vertices[: self._number_words]
+
+    @property
+    def confidences(self):
+        return self._confidences[: self._number_words]
+
+    @property
+    def text_ids(self):
+        return self._text_ids[: self._number_words]
+
+    @property
+    def offsets(self):
+        return self._offsets[: self._number_images + 1]
+
+    @property
+    def word_counts(self):
+        return np.diff(self.offsets)
+
+    def get_text(self, position):
+        return self.texts[self._text_ids[position]]
+
+    def get_texts(self, i):
+        """
+        :return: list of the texts of the image i
+        """
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return [self.texts[text_id] for text_id in self._text_ids[start:end]]
+
+    def word_positions(self, image_indexes, word_index):
+        """
+        This function will give the positions of the word at word_index for the given images.
+        The positions can be used to slice the vertices, confidences and text_ids arrays
+        :param image_indexes: array of image indexes, all having more than word_index words
+        :param word_index: index of the word in the image
+        :return: array of positions
+        """
+        return self.offsets[image_indexes] + word_index
+
+    def count_texts(self, positions):
+        """
+        This function will count the texts of the words at the given positions
+        :param positions: array of positions
+        :return: Counter of the texts, in order of first appearance to keep the Counter tie-breaking
+        """
+        text_ids, first_seen, counts = np.unique(
+            self.text_ids[positions], return_index=True, return_counts=True
+        )
+        text_counts = collections.Counter()
+        for order in np.argsort(first_seen, kind="stable"):
+            text_counts[self.texts[text_ids[order]]] = int(counts[order])
+        return text_counts
+
+    def slice(self, start, end):
+        """
+        This function will copy the ocr results of the images between start and end
+        :param start: index of the first image
+        :param end: index after the last image
+        :return: OCRResults
+        """
+        word_start, word_end = self._offsets[start], self._offsets[end]
+        results = OCRResults(capacity=max(1, word_end - word_start, end - start))
+        results.texts = list(self.texts)
+        results.text_index = dict(self.text_index)
+        results._number_words = word_end - word_start
+        results._number_images = end - start
+        results._vertices[: results._number_words] = self._vertices[word_start:word_end]
+        results._confidences[: results._number_words] = self._confidences[
+            word_start:word_end
+        ]
+        results._text_ids[: results._number_words] = self._text_ids[word_start:word_end]
+        results._offsets[: results._number_images + 1] = (
+            self._offsets[start : end + 1] - word_start
+        )
+        return results
+
+    def split(self, number_shards):
+        """
+        This function will split the ocr results in contiguous shards of images
+        :param number_shards: number of shards
+        :return: list of (index of the first image, OCRResults)
+        """
+        shard_size = max(1, -(-len(self) // number_shards))
+        return [
+            (start, self.slice(start, min(start + shard_size, len(self))))
+            for start in range(0, len(self), shard_size)
+        ]
+
+
+class ClusteringStats:
+    """
+    Partial aggregates used by the clustering, that can be computed on shards of a reel and merged.
+    The aggregates are kept per number of words since the most frequent one is only known once every shard is merged:
+        number_images: number of images summarized
+        word_count_histogram: number of images per number of words
+        bbox_sum: sum of the bounding boxes at each index, per number of words
+        bbox_sum_squares: sum of the squared bounding boxes at each index, per number of words
+        confidence_sum: sum of the OCR confidences at each index, per number of words
+        text_counts: Counter of the texts at each index, per number of words
+    """
+
+    def __init__(self):
+        self.number_images = 0
+        self.word_count_histogram = collections.Counter()
+        self.bbox_sum = {}
+        self.bbox_sum_squares = {}
+        self.confidence_sum = {}
+        self.text_counts = {}
+
+    @classmethod
+    def from_ocr_results(cls, ocr_results):
+        """
+        This function will summarize a list of ocr results
+        :param ocr_results: OCRResults
+        :return: ClusteringStats
+        """
+        stats = cls()
+        word_counts = ocr_results.word_counts
+        stats.number_images = len(ocr_results)
+        stats.word_count_histogram = collections.Counter(word_counts.tolist())
+        for number_word in stats.word_count_histogram:
+            images = np.flatnonzero(word_counts == number_word)
+            bbox_sum = np.zeros((number_word, 4, 2))
+            bbox_sum_squares = np.zeros((number_word, 4, 2))
+            confidence_sum = np.zeros(number_word)
+            text_counts = []
+            for i in range(number_word):
+                positions = ocr_results.word_positions(images, i)
+                bbox = ocr_results.vertices[positions].astype(np.float64)
+                bbox_sum[i] = bbox.sum(axis=0)
+                bbox_sum_squares[i] = (bbox**2).sum(axis=0)
+                confidence_sum[i] = ocr_results.confidences[positions].sum(
+                    dtype=np.float64
+                )
+                text_counts.append(ocr_results.count_texts(positions))
+            stats.bbox_sum[number_word] = bbox_sum
+            stats.bbox_sum_squares[number_word] = bbox_sum_squares
+            stats.confidence_sum[number_word] = confidence_sum
+            stats.text_counts[number_word] = text_counts
+        return stats
+
+    def merge(self, other):
+        """
+        This function will add the aggregates of another shard. Shards should be merged in image order to keep the tie-breaking
+        :param other: ClusteringStats
+        :return: self
+        """
+        self.number_images += other.number_images
+        for number_word, count in other.word_count_histogram.items():
+            if number_word in self.word_count_histogram:
+                self.bbox_sum[number_word] += other.bbox_sum[number_word]
+                self.bbox_sum_squares[number_word] += other.bbox_sum_squares[number_word]
+                self.confidence_sum[number_word] += other.confidence_sum[number_word]
+                for text_counts, other_text_counts in zip(
+                    self.text_counts[number_word], other.text_counts[number_word]
+                ):
+                    text_counts.update(other_text_counts)
+            else:
+                self.bbox_sum[number_word] = other.bbox_sum[number_word].copy()
+                self.bbox_sum_squares[number_word] = other.bbox_sum_squares[
+                    number_word
+                ].copy()
+                self.confidence_sum[number_word] = other.confidence_sum[number_word].copy()
+                self.text_counts[number_word] = [
+                    collections.Counter(text_counts)
+                    for text_counts in other.text_counts[number_word]
+                ]
+            self.word_count_histogram[number_word] += count
+        return self
+
+
 class ClusteringOCR:
     def __init__(self, verbose=False):
         self.verbose = verbose
@@ -147,7 +745,7 @@ class ClusteringOCR:
         """
         This function will generate the stats used by the clustering from a list of ocr results
         Extracting the average bounding box, average text, and average confidence
-        :param ocr_results: list of ocr results
+        :param ocr_results: OCRResults
         :return:
             average_bbox: average bounding box e.g [[345, 218], [580, 218], [580, 333], [345, 333]]
             std_bbox: standard deviation of the bounding box e.g {0: [0.1, 0.3], 1: [0.2, 0.0], 2: [0.1, 0.1], 3: [0.2, 0.2]}
@@ -157,44 +755,47 @@ class ClusteringOCR:
             most_frequent_number_word : the most frequent number of words in the ocr results
         """
 
-        all_bbox = collections.defaultdict(list)
-        outliers_num_words_count = 0
-        all_text = collections.defaultdict(list)
-        all_confidence = collections.defaultdict(list)
+        return self.generate_stats_from_clustering_stats(
+            ClusteringStats.from_ocr_results(ocr_results)
+        )
+
+    def generate_stats_from_clustering_stats(self, stats):
+        """
+        This function will generate the stats used by the clustering from partial aggregates
+        :param stats: ClusteringStats, possibly merged from several shards
+        :return: same as generate_stats_from_ocr_results
+        """
 
         # compute the most frerquent number of words
-        number_words = [len(ocr_data) for ocr_data in ocr_results]
-        most_frequent_number_word = collections.Counter(number_words).most_common(1)[0][
-            0
-        ]
+        most_frequent_number_word = stats.word_count_histogram.most_common(1)[0][0]
+        number_images = stats.word_count_histogram[most_frequent_number_word]
+        outliers_num_words_count = stats.number_images - number_images
+
+        bbox_mean = stats.bbox_sum[most_frequent_number_word] / number_images
+        bbox_variance = (
+            stats.bbox_sum_squares[most_frequent_number_word] / number_images
+            - bbox_mean**2
+        )
+        bbox_std = np.sqrt(np.maximum(bbox_variance, 0))
+        confidence_mean = stats.confidence_sum[most_frequent_number_word] / number_images
 
-        for ocr_data in ocr_results:
-            if len(ocr_data) != most_frequent_number_word:
-                outliers_num_words_count += 1
-                continue
-            for i, ocr_output in enumerate(ocr_data):
-                bbox, text, confidence = ocr_output
-                all_bbox[i].append(bbox)
-                all_text[i].append(text)
-                all_confidence[i].append(confidence)
-        average_bbox = {k: np.mean(v, axis=0) for k, v in all_bbox.items()}
-        std_bbox = {k: np.std(v, axis=0) for k, v in all_bbox.items()}
-        most_common_text_per_index = {
-            k: collections.Counter(v).most_common(1)[0][0] for k, v in all_text.items()
+        average_bbox = {i: bbox_mean[i] for i in range(most_frequent_number_word)}
+        std_bbox = {i: bbox_std[i] for i in range(most_frequent_number_word)}
+        average_confidence = {
+            i: confidence_mean[i] for i in range(most_frequent_number_word)
         }
-        average_confidence = {k: np.mean(v) for k, v in all_confidence.items()}
-        text_frequency_per_index = {
-            k: collections.Counter(v) for k, v in all_text.items()
-        }
-        # normalize frequency
-        for k, v in text_frequency_per_index.items():
-            total = sum(v.values())
-            for key, value in v.items():
-                text_frequency_per_index[k][key] = value / total
+        most_common_text_per_index = {}
+        text_frequency_per_index = {}
+        for i, text_counts in enumerate(stats.text_counts[most_frequent_number_word]):
+            most_common_text_per_index[i] = text_counts.most_common(1)[0][0]
+            # normalize frequency
+            text_frequency_per_index[i] = collections.Counter(
+                {text: count / number_images for text, count in text_counts.items()}
+            )
 
         # if outliers_num_words_count is greater than 10% of the total number of images, then we print a warning
 
-        # if outliers_num_words_count > 0.1 * len(ocr_results):
+        # if outliers_num_words_count > 0.1 * stats.number_images:
         #     print(
         #         f"Warning: {outliers_num_words_count} images were removed from the clustering because they have a different number of words than the most common number of words"
         #     )
@@ -208,19 +809,14 @@ class ClusteringOCR:
             most_frequent_number_word,
         )
 
-    def run(self, ocr_results, image_names, reference_indexes=[], bbox_threshold=50):
+    def score(self, ocr_results, reference, reference_indexes=[], bbox_threshold=50):
         """
-        This function will run the clustering pipeline on a list of ocr results
-        :param ocr_results: list of ocr results
-        :param image_name: name of the image
+        This function will check a list of ocr results against the stats of the reel
+        :param ocr_results: OCRResults
+        :param reference: stats returned by generate_stats_from_ocr_results
         :param reference_indexes: list of indexes to check for anomalies
         :param bbox_threshold: threshold for the bbox clustering
-        :return: list of anomalies in the format (image_name, []anomalies) where anomalies is a dictionary with the following, optional, keys:
-            anomaly_name: name of the anomaly
-            index: index of the anomaly
-            confidence: confidence of the anomaly
-            text: text of the anomaly
-            reference_text: reference text
+        :return: list of indexes with anomalies in the format (index of the image, anomaly)
         """
 
         indexes_with_anomalies = (
@@ -233,7 +829,7 @@ class ClusteringOCR:
             text_frequency_per_index,
             average_confidence,
             most_frequent_number_word,
-        ) = self.generate_stats_from_ocr_results(ocr_results)
+        ) = reference
         # if self.verbose:
             # print("[i] Starting clustering with following stats : ")
             # print("average_bbox : ", average_bbox)
@@ -248,18 +844,19 @@ class ClusteringOCR:
         if len(reference_indexes) == 0:
             reference_indexes = list(range(most_frequent_number_word))
 
+        word_counts = ocr_results.word_counts
+        offsets = ocr_results.offsets
         for i in range(len(ocr_results)):
-            ocr_data = ocr_results[i]
-
-            if len(ocr_data) != most_frequent_number_word:
+            if word_counts[i] != most_frequent_number_word:
                 indexes_with_anomalies.append(
                     (i, {"anomaly_name": "erroneous_number_of_words"})
                 )
                 continue
 
             for index_to_check in reference_indexes:
-                ocr_output = ocr_data[index_to_check]
-                bbox, text, confidence = ocr_output
+                position = offsets[i] + index_to_check
+                bbox = ocr_results.vertices[position]
+                text = ocr_results.get_text(position)
 
                 same_text = text == most_common_text_per_index[index_to_check]
                 if not same_text:
@@ -300,16 +897,97 @@ class ClusteringOCR:
                             },
                         )
                     )
+        return indexes_with_anomalies
+
+    def run_sharded(
+        self, ocr_results, reference_indexes=[], bbox_threshold=50, number_shards=None
+    ):
+        """
+        This function will run the clustering on shards of the reel in a process pool.
+        The shards are summarized in parallel and merged into the stats of the reel, then each shard is checked against them
+        :param ocr_results: OCRResults
+        :param reference_indexes: list of indexes to check for anomalies
+        :param bbox_threshold: threshold for the bbox clustering
+        :param number_shards: number of shards, defaults to the number of cores
+        :return: stats of the reel, list of indexes with anomalies in the format (index of the image, anomaly)
+        """
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        number_shards = number_shards or os.cpu_count() or 1
+        shards = ocr_results.split(number_shards)
+        starts = [start for start, _ in shards]
+        shards = [shard for _, shard in shards]
+
+        # the workers are not forked: the process can hold the thread pools of the OCR libraries,
+        # and the modules import without side effects
+        with ProcessPoolExecutor(
+            max_workers=len(shards), mp_context=multiprocessing.get_context("forkserver")
+        ) as executor:
+            stats = ClusteringStats()
+            for shard_stats in executor.map(ClusteringStats.from_ocr_results, shards):
+                stats.merge(shard_stats)
+            reference = self.generate_stats_from_clustering_stats(stats)
+
+            indexes_with_anomalies = []
+            shard_anomalies = executor.map(
+                self.score,
+                shards,
+                [reference] * len(shards),
+                [reference_indexes] * len(shards),
+                [bbox_threshold] * len(shards),
+            )
+            for start, anomalies in zip(starts, shard_anomalies):
+                indexes_with_anomalies.extend(
+                    (start + i, anomaly) for i, anomaly in anomalies
+                )
+
+        return reference, indexes_with_anomalies
+
+    def run(
+        self,
+        ocr_results,
+        image_names,
+        reference_indexes=[],
+        bbox_threshold=50,
+        number_shards=1,
+    ):
+        """
+        This function will run the clustering pipeline on a list of ocr results
+        :param ocr_results: OCRResults
+        :param image_name: name of the image
+        :param reference_indexes: list of indexes to check for anomalies
+        :param bbox_threshold: threshold for the bbox clustering
+        :param number_shards: number of shards to run the clustering on in parallel, see run_sharded
+        :return: list of anomalies in the format (image_name, []anomalies) where anomalies is a dictionary with the following, optional, keys:
+            anomaly_name: name of the anomaly
+            index: index of the anomaly
+            confidence: confidence of the anomaly
+            text: text of the anomaly
+            reference_text: reference text
+        """
+
+        if number_shards > 1:
+            reference, indexes_with_anomalies = self.run_sharded(
+                ocr_results, reference_indexes, bbox_threshold, number_shards
+            )
+        else:
+            reference = self.generate_stats_from_ocr_results(ocr_results)
+            indexes_with_anomalies = self.score(
+                ocr_results, reference, reference_indexes, bbox_threshold
+            )
+        most_common_text_per_index = reference[2]
 
         # building the final output by concatenating the different anomalies for each image
 
+        anomalies_per_image = collections.defaultdict(list)
+        for anomaly in indexes_with_anomalies:
+            anomalies_per_image[anomaly[0]].append(anomaly)
+
         final_output = []
         for i in range(len(ocr_results)):
-            ocr_data = ocr_results[i]
             image_name = image_names[i]
-            anomalies = [
-                anomaly for anomaly in indexes_with_anomalies if anomaly[0] == i
-            ]
+            anomalies = anomalies_per_image.get(i, [])
             if len(anomalies) > 0:
                 final_output.append((image_name, anomalies))
 
@@ -318,8 +996,9 @@ class ClusteringOCR:
             anomaly_count = collections.Counter(
                 [anomaly[1]["anomaly_name"] for anomaly in indexes_with_anomalies]
             )
-            print("[+] Clustering done...")
-            print("Anomalies : ", anomaly_count)
+            # stdout only carries the JSON output
+            print("[+] Clustering done...", file=sys.stderr)
+            print("Anomalies : ", anomaly_count, file=sys.stderr)
 
         return most_common_text_per_index, final_output
 
@@ -333,6 +1012,8 @@ def combine_string_from_array(array):
 
 
 def is_similar(string1, string2):
+    import Levenshtein
+
     # levenshtein distance: the minimum number of single-character edits
     distance = Levenshtein.distance(string1, string2)
     similarity = 1 - (distance / max(len(string1), len(string2)))
@@ -349,95 +1030,171 @@ def move_files(file_paths, destination_directory):
     return destination_directory
 
 
-directory = "/Users/clarkfan/Desktop/test_image/" + sys.argv[1]
-
-golden_sample = json.loads(sys.argv[2])
-
-has_error = False
-saved_exception = None
-# Iterate over the sorted image files
-try:
-    x = golden_sample['cropArea']['x']
-    y = golden_sample['cropArea']['y']
-    width = golden_sample['cropArea']['width']
-    height = golden_sample['cropArea']['height']
-
-    destination_path = directory + "_anomaly"
-    os.makedirs(destination_path, exist_ok=True)
-
-    paths = [
-        os.path.abspath(os.path.join(directory, filename))
-        for filename in os.listdir(directory)
-        if os.path.isfile(os.path.join(directory, filename))
-        and filename.endswith((".jpg", ".jpeg", ".png", ".gif", ".bmp"))
-    ]
-    paths = sorted(paths)
-
-    # Parameters
-    # will change for every reel
-    IS_PATH_LOCAL = True
-    VERBOSE = False
-    # no need to tune
-    USE_IMAGE_FILTER = True
-    USE_BINARIZATION_THRESHOLD = 0  # 0 for no binarization
-    OCR_BATCH_SIZE = 16
-    BBOX_DISTANCE_THRESHOLD = 50
-
-    start_time = time.time()
-    # Running the image processor for all the pictures. This works faster if ran on GPU.
-    image_ocr_processor = ImageOCRProcessor()
-    image_processor = ImagePreprocessor(
-        use_filter=USE_IMAGE_FILTER,
-        use_binarization_threshold=USE_BINARIZATION_THRESHOLD,
-        is_local=IS_PATH_LOCAL,
-        verbose=VERBOSE,
-    )
-    ocr_results = image_ocr_processor.run_batch(
-        paths, batch_size=OCR_BATCH_SIZE, preprocessor=image_processor
-    )
-
-    end_time = time.time()
-    execution_time = end_time - start_time
-    # print(f"Execution time: {execution_time} seconds")
-    # print("image processed: " + str(len(paths)))
-
-    # Instancating the OCR clustering
-    clustering_ocr = ClusteringOCR(verbose=True)
-
-    # Running the clustering
-    most_common_text_per_index, clustering_output = clustering_ocr.run(
-        ocr_results, paths, reference_indexes=[], bbox_threshold=BBOX_DISTANCE_THRESHOLD
-    )
-
-    #  Displaying the result
-    reference_string = combine_string_from_dict(most_common_text_per_index)
-    anomaly_set = set()
-
-    for cluster_res in clustering_output:
-        image_name, anomalies = cluster_res
-        ind = anomalies[0][0]
-        ocr_text = []
-        for k in range(len(ocr_results[ind])):
-            bbox, ocr, confidence = ocr_results[ind][k]
-            ocr_text.append(ocr)
-        if len(ocr_text) == 0:
-            anomaly_set.add(image_name)
-            continue
-        extracted_str = combine_string_from_array(ocr_text)
-        if not is_similar(reference_string, extracted_str):
-            anomaly_set.add(image_name)
-            continue
-    move_files(anomaly_set, destination_path)
-except Exception as e:
-    has_error = True
-    saved_exception = e
-    pass
-
-output = {
-    "anomalyPct": len(anomaly_set) / len(paths),
-    "anomalyImages": destination_path,
-    "hasError": has_error,
-}
-print(json.dumps(output))
-if has_error:
-    raise saved_exception
\ No newline at end of file
+def emit_event(event, **data):
+    """
+    This function will print a progress event as a JSON line. The final output is still printed last, without an event key
+    :param event: name of the event
+    :param data: content of the event
+    """
+    print(json.dumps({"event": event, **data}), flush=True)
+
+
+def main(argv):
+    # with --stream, progress events are printed as JSON lines before the final output
+    stream = "--stream" in argv
+    argv = [arg for arg in argv if arg != "--stream"]
+
+    directory = "/Users/clarkfan/Desktop/test_image/" + argv[1]
+
+    golden_sample = json.loads(argv[2])
+
+    has_error = False
+    saved_exception = None
+    # Iterate over the sorted image files
+    try:
+        destination_path = directory + "_anomaly"
+        os.makedirs(destination_path, exist_ok=True)
+
+        paths = [
+            os.path.abspath(os.path.join(directory, filename))
+            for filename in os.listdir(directory)
+            if os.path.isfile(os.path.join(directory, filename))
+            and filename.endswith((".jpg", ".jpeg", ".png", ".gif", ".bmp"))
+        ]
+        paths = sorted(paths)
+
+        # Parameters
+        # will change for every reel
+        IS_PATH_LOCAL = True
+        VERBOSE = False
+        # no need to tune
+        USE_IMAGE_FILTER = True
+        USE_BINARIZATION_THRESHOLD = 0  # 0 for no binarization
+        OCR_BATCH_SIZE = 16  # only used when the batch size is not autotuned
+        # the batch size is picked from the throughput and memory measured on the first frames
+        OCR_AUTOTUNE_BATCH_SIZE = True
+        OCR_MEMORY_LIMIT_MB = None  # None for half of the physical memory
+        BBOX_DISTANCE_THRESHOLD = 50
+        # reels with at least this many images are clustered in parallel on every core
+        SHARDED_CLUSTERING_MIN_IMAGES = 20000
+        # the word layout is fixed for a reel, the text detection only runs on the first frames and a sample of the reel.
+        # Off by default: the bbox and number of words anomalies are only caught on the sampled frames in this mode
+        USE_FIXED_WORD_REGIONS = False
+        REGION_LEARNING_FRAMES = 8
+        REGION_MIN_CONFIDENCE = 0.3
+        # the text detection checks the learned layout on every n-th frame, the bbox and number of words anomalies
+        # of the other frames are missed. Lower to catch more of them, 0 to never check
+        REGION_VERIFY_INTERVAL = 10
+        REGION_LAYOUT_TOLERANCE = 25  # in pixels
+        # number of flagged images per anomalies event
+        PROGRESS_BATCH_SIZE = 500
+
+        def report_progress(frames_done, batch_frames, batch_time):
+            if stream:
+                emit_event(
+                    "progress",
+                    stage="ocr",
+                    framesDone=frames_done,
+                    totalFrames=len(paths),
+                    batchFrames=batch_frames,
+                    batchSeconds=round(batch_time, 3),
+                )
+
+        start_time = time.time()
+        # Running the image processor for all the pictures. This works faster if ran on GPU.
+        image_ocr_processor = ImageOCRProcessor()
+        image_processor = ImagePreprocessor(
+            use_filter=USE_IMAGE_FILTER,
+            use_binarization_threshold=USE_BINARIZATION_THRESHOLD,
+            is_local=IS_PATH_LOCAL,
+            verbose=VERBOSE,
+            crop_area=golden_sample['cropArea'],
+        )
+        ocr_results = image_ocr_processor.run_batch(
+            paths,
+            batch_size=OCR_BATCH_SIZE,
+            preprocessor=image_processor,
+            use_fixed_regions=USE_FIXED_WORD_REGIONS,
+            region_learning_frames=REGION_LEARNING_FRAMES,
+            min_confidence=REGION_MIN_CONFIDENCE,
+            verify_interval=REGION_VERIFY_INTERVAL,
+            layout_tolerance=REGION_LAYOUT_TOLERANCE,
+            autotune=OCR_AUTOTUNE_BATCH_SIZE,
+            memory_limit_mb=OCR_MEMORY_LIMIT_MB,
+            progress_callback=report_progress,
+        )
+
+        end_time = time.time()
+        execution_time = end_time - start_time
+        # print(f"Execution time: {execution_time} seconds")
+        # print("image processed: " + str(len(paths)))
+
+        # Instancating the OCR clustering
+        clustering_ocr = ClusteringOCR(verbose=True)
+
+        # Running the clustering
+        clustering_start_time = time.time()
+        number_shards = 1
+        if len(ocr_results) >= SHARDED_CLUSTERING_MIN_IMAGES:
+            number_shards = os.cpu_count() or 1
+        most_common_text_per_index, clustering_output = clustering_ocr.run(
+            ocr_results,
+            paths,
+            reference_indexes=[],
+            bbox_threshold=BBOX_DISTANCE_THRESHOLD,
+            number_shards=number_shards,
+        )
+        if stream:
+            emit_event(
+                "progress",
+                stage="clustering",
+                framesDone=len(ocr_results),
+                totalFrames=len(paths),
+                batchFrames=len(ocr_results),
+                batchSeconds=round(time.time() - clustering_start_time, 3),
+            )
+
+        #  Displaying the result
+        reference_string = combine_string_from_dict(most_common_text_per_index)
+        anomaly_set = set()
+        anomaly_images = []
+
+        for image_name, anomalies in clustering_output:
+            ind = anomalies[0][0]
+            ocr_text = ocr_results.get_texts(ind)
+            if len(ocr_text) == 0 or not is_similar(
+                reference_string, combine_string_from_array(ocr_text)
+            ):
+                anomaly_set.add(image_name)
+                anomaly_images.append(image_name)
+
+        # the anomalies are only known once the whole reel is clustered, the progress events of the OCR carry no anomaly count.
+        # The flagged images are sent in chunks to keep every event small enough for a SQS message
+        if stream:
+            for i in range(0, len(anomaly_images), PROGRESS_BATCH_SIZE):
+                emit_event(
+                    "anomalies",
+                    anomalyCount=len(anomaly_set),
+                    newAnomalyImages=[
+                        {"path": path}
+                        for path in anomaly_images[i : i + PROGRESS_BATCH_SIZE]
+                    ],
+                )
+        move_files(anomaly_set, destination_path)
+    except Exception as e:
+        has_error = True
+        saved_exception = e
+        pass
+
+    output = {
+        "anomalyPct": len(anomaly_set) / len(paths),
+        "anomalyImages": destination_path,
+        "hasError": has_error,
+    }
+    print(json.dumps(output))
+    if has_error:
+        raise saved_exception
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -192,6 +192,11 @@ app.get('/result', async (req, res) => {
             // TODO:
             // group it in python, and handle it here
             console.log('Python script says:', messageFromPy);
+            try {
+                JSON.parse(messageFromPy);
+            } catch (error) {
+                return;
+            }
             output = messageFromPy;
         });
 
@@ -3,8 +3,273 @@ import sys
 import json
 import numpy as np
 import collections
-import Levenshtein
 import shutil
+import time
+
+class OCRResults:
+    """
+    Compact storage for the OCR results of a reel.
+    Instead of one python object per vertex coordinate, the words of all the images are stored in contiguous arrays:
+        vertices: bounding box of every word, shape (number of words, 4, 2)
+        confidences: OCR confidence of every word, shape (number of words,)
+        text_ids: index of the text of every word in the texts table, shape (number of words,)
+        offsets: index of the first word of every image, shape (number of images + 1,)
+    The word at index k of the image i is stored at offsets[i] + k
+    """
+
+    def __init__(self, capacity=1024):
+        self.texts = []  # interned string table
+        self.text_index = {}
+        self._vertices = np.zeros((capacity, 4, 2), dtype=np.float32)
+        self._confidences = np.zeros(capacity, dtype=np.float32)
+        self._text_ids = np.zeros(capacity, dtype=np.int32)
+        self._offsets = np.zeros(capacity + 1, dtype=np.int64)
+        self._number_words = 0
+        self._number_images = 0
+
+    @classmethod
+    def from_list(cls, ocr_results):
+        """
+        This function will build the compact storage from a list of ocr results
+        :param ocr_results: list of ocr results of the shape [][](bbox, text, confidence)
+        :return: OCRResults
+        """
+        number_words = sum(len(ocr_data) for ocr_data in ocr_results)
+        results = cls(capacity=max(1, number_words, len(ocr_results)))
+        results.extend(ocr_results)
+        return results
+
+    def intern_text(self, text):
+        text_id = self.text_index.get(text)
+        if text_id is None:
+            text_id = len(self.texts)
+            self.text_index[text] = text_id
+            self.texts.append(text)
+        return text_id
+
+    def _grow(self, array, size):
+        # doubling the capacity keeps the appends amortized O(1)
+        capacity = len(array)
+        if size <= capacity:
+            return array
+        while capacity < size:
+            capacity *= 2
+        grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+        grown[: len(array)] = array
+        return grown
+
+    def append(self, ocr_data):
+        """
+        This function will add the ocr result of one image
+        :param ocr_data: list of ocr outputs of the shape [](bbox, text, confidence)
+        """
+        start = self._number_words
+        end = start + len(ocr_data)
+        self._vertices = self._grow(self._vertices, end)
+        self._confidences = self._grow(self._confidences, end)
+        self._text_ids = self._grow(self._text_ids, end)
+        self._offsets = self._grow(self._offsets, self._number_images + 2)
+
+        for position, (bbox, text, confidence) in enumerate(ocr_data, start):
+            self._vertices[position] = bbox
+            self._confidences[position] = confidence
+            self._text_ids[position] = self.intern_text(text)
+        self._number_words = end
+        self._number_images += 1
+        self._offsets[self._number_images] = end
+
+    def extend(self, ocr_results):
+        for ocr_data in ocr_results:
+            self.append(ocr_data)
+
+    def __len__(self):
+        return self._number_images
+
+    def __getitem__(self, i):
+        """
+        :return: ocr result of the image i in the shape [](bbox, text, confidence)
+        """
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return [
+            (
+                self._vertices[position],
+                self.texts[self._text_ids[position]],
+                float(self._confidences[position]),
+            )
+            for position in range(start, end)
+        ]
+
+    @property
+    def vertices(self):
+        return self._vertices[: self._number_words]
+
+    @property
+    def confidences(self):
+        return self._confidences[: self._number_words]
+
+    @property
+    def text_ids(self):
+        return self._text_ids[: self._number_words]
+
+    @property
+    def offsets(self):
+        return self._offsets[: self._number_images + 1]
+
+    @property
+    def word_counts(self):
+        return np.diff(self.offsets)
+
+    def get_text(self, position):
+        return self.texts[self._text_ids[position]]
+
+    def get_texts(self, i):
+        """
+        :return: list of the texts of the image i
+        """
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return [self.texts[text_id] for text_id in self._text_ids[start:end]]
+
+    def word_positions(self, image_indexes, word_index):
+        """
+        This function will give the positions of the word at word_index for the given images.
+        The positions can be used to slice the vertices, confidences and text_ids arrays
+        :param image_indexes: array of image indexes, all having more than word_index words
+        :param word_index: index of the word in the image
+        :return: array of positions
+        """
+        return self.offsets[image_indexes] + word_index
+
+    def count_texts(self, positions):
+        """
+        This function will count the texts of the words at the given positions
+        :param positions: array of positions
+        :return: Counter of the texts, in order of first appearance to keep the Counter tie-breaking
+        """
+        text_ids, first_seen, counts = np.unique(
+            self.text_ids[positions], return_index=True, return_counts=True
+        )
+        text_counts = collections.Counter()
+        for order in np.argsort(first_seen, kind="stable"):
+            text_counts[self.texts[text_ids[order]]] = int(counts[order])
+        return text_counts
+
+    def slice(self, start, end):
+        """
+        This function will copy the ocr results of the images between start and end
+        :param start: index of the first image
+        :param end: index after the last image
+        :return: OCRResults
+        """
+        word_start, word_end = self._offsets[start], self._offsets[end]
+        results = OCRResults(capacity=max(1, word_end - word_start, end - start))
+        results.texts = list(self.texts)
+        results.text_index = dict(self.text_index)
+        results._number_words = word_end - word_start
+        results._number_images = end - start
+        results._vertices[: results._number_words] = self._vertices[word_start:word_end]
+        results._confidences[: results._number_words] = self._confidences[
+            word_start:word_end
+        ]
+        results._text_ids[: results._number_words] = self._text_ids[word_start:word_end]
+        results._offsets[: results._number_images + 1] = (
+            self._offsets[start : end + 1] - word_start
+        )
+        return results
+
+    def split(self, number_shards):
+        """
+        This function will split the ocr results in contiguous shards of images
+        :param number_shards: number of shards
+        :return: list of (index of the first image, OCRResults)
+        """
+        shard_size = max(1, -(-len(self) // number_shards))
+        return [
+            (start, self.slice(start, min(start + shard_size, len(self))))
+            for start in range(0, len(self), shard_size)
+        ]
+
+
+class ClusteringStats:
+    """
+    Partial aggregates used by the clustering, that can be computed on shards of a reel and merged.
+    The aggregates are kept per number of words since the most frequent one is only known once every shard is merged:
+        number_images: number of images summarized
+        word_count_histogram: number of images per number of words
+        bbox_sum: sum of the bounding boxes at each index, per number of words
+        bbox_sum_squares: sum of the squared bounding boxes at each index, per number of words
+        confidence_sum: sum of the OCR confidences at each index, per number of words
+        text_counts: Counter of the texts at each index, per number of words
+    """
+
+    def __init__(self):
+        self.number_images = 0
+        self.word_count_histogram = collections.Counter()
+        self.bbox_sum = {}
+        self.bbox_sum_squares = {}
+        self.confidence_sum = {}
+        self.text_counts = {}
+
+    @classmethod
+    def from_ocr_results(cls, ocr_results):
+        """
+        This function will summarize a list of ocr results
+        :param ocr_results: OCRResults
+        :return: ClusteringStats
+        """
+        stats = cls()
+        word_counts = ocr_results.word_counts
+        stats.number_images = len(ocr_results)
+        stats.word_count_histogram = collections.Counter(word_counts.tolist())
+        for number_word in stats.word_count_histogram:
+            images = np.flatnonzero(word_counts == number_word)
+            bbox_sum = np.zeros((number_word, 4, 2))
+            bbox_sum_squares = np.zeros((number_word, 4, 2))
+            confidence_sum = np.zeros(number_word)
+            text_counts = []
+            for i in range(number_word):
+                positions = ocr_results.word_positions(images, i)
+                bbox = ocr_results.vertices[positions].astype(np.float64)
+                bbox_sum[i] = bbox.sum(axis=0)
+                bbox_sum_squares[i] = (bbox**2).sum(axis=0)
+                confidence_sum[i] = ocr_results.confidences[positions].sum(
+                    dtype=np.float64
+                )
+                text_counts.append(ocr_results.count_texts(positions))
+            stats.bbox_sum[number_word] = bbox_sum
+            stats.bbox_sum_squares[number_word] = bbox_sum_squares
+            stats.confidence_sum[number_word] = confidence_sum
+            stats.text_counts[number_word] = text_counts
+        return stats
+
+    def merge(self, other):
+        """
+        This function will add the aggregates of another shard. Shards should be merged in image order to keep the tie-breaking
+        :param other: ClusteringStats
+        :return: self
+        """
+        self.number_images += other.number_images
+        for number_word, count in other.word_count_histogram.items():
+            if number_word in self.word_count_histogram:
+                self.bbox_sum[number_word] += other.bbox_sum[number_word]
+                self.bbox_sum_squares[number_word] += other.bbox_sum_squares[number_word]
+                self.confidence_sum[number_word] += other.confidence_sum[number_word]
+                for text_counts, other_text_counts in zip(
+                    self.text_counts[number_word], other.text_counts[number_word]
+                ):
+                    text_counts.update(other_text_counts)
+            else:
+                self.bbox_sum[number_word] = other.bbox_sum[number_word].copy()
+                self.bbox_sum_squares[number_word] = other.bbox_sum_squares[
+                    number_word
+                ].copy()
+                self.confidence_sum[number_word] = other.confidence_sum[number_word].copy()
+                self.text_counts[number_word] = [
+                    collections.Counter(text_counts)
+                    for text_counts in other.text_counts[number_word]
+                ]
+            self.word_count_histogram[number_word] += count
+        return self
+
 
 class ClusteringOCR:
     def __init__(self, verbose=False):
@@ -47,7 +312,7 @@ class ClusteringOCR:
         """
         This function will generate the stats used by the clustering from a list of ocr results
         Extracting the average bounding box, average text, and average confidence
-        :param ocr_results: list of ocr results
+        :param ocr_results: OCRResults
         :return:
             average_bbox: average bounding box e.g [[345, 218], [580, 218], [580, 333], [345, 333]]
             std_bbox: standard deviation of the bounding box e.g {0: [0.1, 0.3], 1: [0.2, 0.0], 2: [0.1, 0.1], 3: [0.2, 0.2]}
@@ -57,46 +322,50 @@ class ClusteringOCR:
             most_frequent_number_word : the most frequent number of words in the ocr results
         """
 
-        all_bbox = collections.defaultdict(list)
-        outliers_num_words_count = 0
-        all_text = collections.defaultdict(list)
-        all_confidence = collections.defaultdict(list)
+        return self.generate_stats_from_clustering_stats(
+            ClusteringStats.from_ocr_results(ocr_results)
+        )
+
+    def generate_stats_from_clustering_stats(self, stats):
+        """
+        This function will generate the stats used by the clustering from partial aggregates
+        :param stats: ClusteringStats, possibly merged from several shards
+        :return: same as generate_stats_from_ocr_results
+        """
 
         # compute the most frerquent number of words
-        number_words = [len(ocr_data) for ocr_data in ocr_results]
-        most_frequent_number_word = collections.Counter(number_words).most_common(1)[0][
-            0
-        ]
+        most_frequent_number_word = stats.word_count_histogram.most_common(1)[0][0]
+        number_images = stats.word_count_histogram[most_frequent_number_word]
+        outliers_num_words_count = stats.number_images - number_images
+
+        bbox_mean = stats.bbox_sum[most_frequent_number_word] / number_images
+        bbox_variance = (
+            stats.bbox_sum_squares[most_frequent_number_word] / number_images
+            - bbox_mean**2
+        )
+        bbox_std = np.sqrt(np.maximum(bbox_variance, 0))
+        confidence_mean = stats.confidence_sum[most_frequent_number_word] / number_images
 
-        for ocr_data in ocr_results:
-            if len(ocr_data) != most_frequent_number_word:
-                outliers_num_words_count += 1
-                continue
-            for i, ocr_output in enumerate(ocr_data):
-                bbox, text, confidence = ocr_output
-                all_bbox[i].append(bbox)
-                all_text[i].append(text)
-                all_confidence[i].append(confidence)
-        average_bbox = {k: np.mean(v, axis=0) for k, v in all_bbox.items()}
-        std_bbox = {k: np.std(v, axis=0) for k, v in all_bbox.items()}
-        most_common_text_per_index = {
-            k: collections.Counter(v).most_common(1)[0][0] for k, v in all_text.items()
-        }
-        average_confidence = {k: np.mean(v) for k, v in all_confidence.items()}
-        text_frequency_per_index = {
-            k: collections.Counter(v) for k, v in all_text.items()
+        average_bbox = {i: bbox_mean[i] for i in range(most_frequent_number_word)}
+        std_bbox = {i: bbox_std[i] for i in range(most_frequent_number_word)}
+        average_confidence = {
+            i: confidence_mean[i] for i in range(most_frequent_number_word)
         }
-        # normalize frequency
-        for k, v in text_frequency_per_index.items():
-            total = sum(v.values())
-            for key, value in v.items():
-                text_frequency_per_index[k][key] = value / total
+        most_common_text_per_index = {}
+        text_frequency_per_index = {}
+        for i, text_counts in enumerate(stats.text_counts[most_frequent_number_word]):
+            most_common_text_per_index[i] = text_counts.most_common(1)[0][0]
+            # normalize frequency
+            text_frequency_per_index[i] = collections.Counter(
+                {text: count / number_images for text, count in text_counts.items()}
+            )
 
         # if outliers_num_words_count is greater than 10% of the total number of images, then we print a warning
 
-        if outliers_num_words_count > 0.1 * len(ocr_results):
+        if outliers_num_words_count > 0.1 * stats.number_images:
             print(
-                f"Warning: {outliers_num_words_count} images were removed from the clustering because they have a different number of words than the most common number of words"
+                f"Warning: {outliers_num_words_count} images were removed from the clustering because they have a different number of words than the most common number of words",
+                file=sys.stderr,
             )
 
         return (
@@ -108,19 +377,14 @@ class ClusteringOCR:
             most_frequent_number_word,
         )
 
-    def run(self, ocr_results, image_names, reference_indexes=[], bbox_threshold=50):
+    def score(self, ocr_results, reference, reference_indexes=[], bbox_threshold=50):
         """
-        This function will run the clustering pipeline on a list of ocr results
-        :param ocr_results: list of ocr results
-        :param image_name: name of the image
+        This function will check a list of ocr results against the stats of the reel
+        :param ocr_results: OCRResults
+        :param reference: stats returned by generate_stats_from_ocr_results
         :param reference_indexes: list of indexes to check for anomalies
         :param bbox_threshold: threshold for the bbox clustering
-        :return: list of anomalies in the format (image_name, []anomalies) where anomalies is a dictionary with the following, optional, keys:
-            anomaly_name: name of the anomaly
-            index: index of the anomaly
-            confidence: confidence of the anomaly
-            text: text of the anomaly
-            reference_text: reference text
+        :return: list of indexes with anomalies in the format (index of the image, anomaly)
         """
 
         indexes_with_anomalies = (
@@ -133,23 +397,24 @@ class ClusteringOCR:
             text_frequency_per_index,
             average_confidence,
             most_frequent_number_word,
-        ) = self.generate_stats_from_ocr_results(ocr_results)
+        ) = reference
 
         if len(reference_indexes) == 0:
             reference_indexes = list(range(most_frequent_number_word))
 
+        word_counts = ocr_results.word_counts
+        offsets = ocr_results.offsets
         for i in range(len(ocr_results)):
-            ocr_data = ocr_results[i]
-
-            if len(ocr_data) != most_frequent_number_word:
+            if word_counts[i] != most_frequent_number_word:
                 indexes_with_anomalies.append(
                     (i, {"anomaly_name": "erroneous_number_of_words"})
                 )
                 continue
 
             for index_to_check in reference_indexes:
-                ocr_output = ocr_data[index_to_check]
-                bbox, text, confidence = ocr_output
+                position = offsets[i] + index_to_check
+                bbox = ocr_results.vertices[position]
+                text = ocr_results.get_text(position)
 
                 same_text = text == most_common_text_per_index[index_to_check]
                 if not same_text:
@@ -190,16 +455,97 @@ class ClusteringOCR:
                             },
                         )
                     )
+        return indexes_with_anomalies
+
+    def run_sharded(
+        self, ocr_results, reference_indexes=[], bbox_threshold=50, number_shards=None
+    ):
+        """
+        This function will run the clustering on shards of the reel in a process pool.
+        The shards are summarized in parallel and merged into the stats of the reel, then each shard is checked against them
+        :param ocr_results: OCRResults
+        :param reference_indexes: list of indexes to check for anomalies
+        :param bbox_threshold: threshold for the bbox clustering
+        :param number_shards: number of shards, defaults to the number of cores
+        :return: stats of the reel, list of indexes with anomalies in the format (index of the image, anomaly)
+        """
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        number_shards = number_shards or os.cpu_count() or 1
+        shards = ocr_results.split(number_shards)
+        starts = [start for start, _ in shards]
+        shards = [shard for _, shard in shards]
+
+        # the workers are not forked: the process can hold the thread pools of the OCR libraries,
+        # and the modules import without side effects
+        with ProcessPoolExecutor(
+            max_workers=len(shards), mp_context=multiprocessing.get_context("forkserver")
+        ) as executor:
+            stats = ClusteringStats()
+            for shard_stats in executor.map(ClusteringStats.from_ocr_results, shards):
+                stats.merge(shard_stats)
+            reference = self.generate_stats_from_clustering_stats(stats)
+
+            indexes_with_anomalies = []
+            shard_anomalies = executor.map(
+                self.score,
+                shards,
+                [reference] * len(shards),
+                [reference_indexes] * len(shards),
+                [bbox_threshold] * len(shards),
+            )
+            for start, anomalies in zip(starts, shard_anomalies):
+                indexes_with_anomalies.extend(
+                    (start + i, anomaly) for i, anomaly in anomalies
+                )
+
+        return reference, indexes_with_anomalies
+
+    def run(
+        self,
+        ocr_results,
+        image_names,
+        reference_indexes=[],
+        bbox_threshold=50,
+        number_shards=1,
+    ):
+        """
+        This function will run the clustering pipeline on a list of ocr results
+        :param ocr_results: OCRResults
+        :param image_name: name of the image
+        :param reference_indexes: list of indexes to check for anomalies
+        :param bbox_threshold: threshold for the bbox clustering
+        :param number_shards: number of shards to run the clustering on in parallel, see run_sharded
+        :return: list of anomalies in the format (image_name, []anomalies) where anomalies is a dictionary with the following, optional, keys:
+            anomaly_name: name of the anomaly
+            index: index of the anomaly
+            confidence: confidence of the anomaly
+            text: text of the anomaly
+            reference_text: reference text
+        """
+
+        if number_shards > 1:
+            reference, indexes_with_anomalies = self.run_sharded(
+                ocr_results, reference_indexes, bbox_threshold, number_shards
+            )
+        else:
+            reference = self.generate_stats_from_ocr_results(ocr_results)
+            indexes_with_anomalies = self.score(
+                ocr_results, reference, reference_indexes, bbox_threshold
+            )
+        most_common_text_per_index = reference[2]
 
         # building the final output by concatenating the different anomalies for each image
 
+        anomalies_per_image = collections.defaultdict(list)
+        for anomaly in indexes_with_anomalies:
+            anomalies_per_image[anomaly[0]].append(anomaly)
+
         final_output = []
         for i in range(len(ocr_results)):
-            ocr_data = ocr_results[i]
             image_name = image_names[i]
-            anomalies = [
-                anomaly for anomaly in indexes_with_anomalies if anomaly[0] == i
-            ]
+            anomalies = anomalies_per_image.get(i, [])
             if len(anomalies) > 0:
                 final_output.append((image_name, anomalies))
         return most_common_text_per_index, final_output
@@ -214,6 +560,8 @@ def combine_string_from_array(array):
 
 
 def is_similar(string1, string2):
+    import Levenshtein
+
     # levenshtein distance: the minimum number of single-character edits
     distance = Levenshtein.distance(string1, string2)
     similarity = 1 - (distance / max(len(string1), len(string2)))
@@ -230,77 +578,126 @@ def move_files(file_paths, destination_directory):
     return destination_path
 
 def convert_vision_ai_output(vision_ai_responses):
-    output = []
+    output = OCRResults(capacity=max(1, len(vision_ai_responses)) * 8)
     for res in vision_ai_responses:
         for item in res:
             bounding_boxs = item['textAnnotations']
             if bounding_boxs != None and len(bounding_boxs) > 0 and 'locale' in bounding_boxs[0]:
                 bounding_boxs = bounding_boxs[1:]
-            converted_format = [(list(map(lambda v: [v['x'], v['y']], bb['boundingPoly']['vertices'])),
+            # vision ai omits the coordinates equal to 0
+            converted_format = [(list(map(lambda v: [v.get('x', 0), v.get('y', 0)], bb['boundingPoly']['vertices'])),
                     bb['description'],
                     1.0) for bb in bounding_boxs]
             output.append(converted_format)
     return output
 
-has_error = False
-saved_exception = None
-clustered_set = set()
-anomaly_set = set()
-path_id_map = {}
-
-# Iterate over the sorted image files
-try:
-    IS_PATH_LOCAL = True
-    VERBOSE = False
-    BBOX_DISTANCE_THRESHOLD = 50
-    # Read the object from standard input
-    json_file_name = sys.argv[1]
-
-    with open(json_file_name) as file:
-        data = json.load(file)
-    # Parse the JSON string back into a Python object
-    ocr_results = convert_vision_ai_output(data['visionAiResponses'])
-    paths = data['filePaths']
-    ids = data['ids']
-    for i in range(len(paths)):
-        path_id_map[paths[i]] = ids[i]
-    # Instancating the OCR clustering
-    clustering_ocr = ClusteringOCR(verbose=True)
-
-    # Running the clustering
-    most_common_text_per_index, clustering_output = clustering_ocr.run(
-        ocr_results, paths, reference_indexes=[], bbox_threshold=BBOX_DISTANCE_THRESHOLD
-    )
-
-    #  Displaying the result
-    reference_string = combine_string_from_dict(most_common_text_per_index)
-
-    for cluster_res in clustering_output:
-        image_name, anomalies = cluster_res
-        ind = anomalies[0][0]
-        ocr_text = []
-        for k in range(len(ocr_results[ind])):
-            bbox, ocr, confidence = ocr_results[ind][k]
-            ocr_text.append(ocr)
-        if len(ocr_text) == 0:
-            anomaly_set.add(image_name)
-            continue
-        extracted_str = combine_string_from_array(ocr_text)
-        if not is_similar(reference_string, extracted_str):
-            anomaly_set.add(image_name)
-            continue
-        clustered_set.add(image_name)
-except Exception as e:
-    has_error = True
-    saved_exception = e
-    pass
-
-# TODO: handle more logic here and think about how we can cluster it together, and what response we want from this API
-output = {
-    "clusteredImages": [{"id": path_id_map[i], "path": i} for i in list(clustered_set)],
-    "anomalyImages": [{"id": path_id_map[i], "path": i} for i in list(anomaly_set)],
-    "hasError": has_error,
-}
-print(json.dumps(output))
-if has_error:
-    raise saved_exception
\ No newline at end of file
+def emit_event(event, **data):
+    """
+    This function will print a progress event as a JSON line. The final output is still printed last, without an event key
+    :param event: name of the event
+    :param data: content of the event
+    """
+    print(json.dumps({"event": event, **data}), flush=True)
+
+
+def main(argv):
+    # with --stream, progress events are printed as JSON lines before the final output
+    stream = "--stream" in argv
+    argv = [arg for arg in argv if arg != "--stream"]
+
+    has_error = False
+    saved_exception = None
+    clustered_set = set()
+    anomaly_set = set()
+    path_id_map = {}
+
+    # Iterate over the sorted image files
+    try:
+        IS_PATH_LOCAL = True
+        VERBOSE = False
+        BBOX_DISTANCE_THRESHOLD = 50
+        # reels with at least this many images are clustered in parallel on every core
+        SHARDED_CLUSTERING_MIN_IMAGES = 20000
+        # number of flagged images per anomalies event
+        PROGRESS_BATCH_SIZE = 500
+        # Read the object from standard input
+        json_file_name = argv[1]
+
+        with open(json_file_name) as file:
+            data = json.load(file)
+        # Parse the JSON string back into a Python object
+        ocr_results = convert_vision_ai_output(data['visionAiResponses'])
+        paths = data['filePaths']
+        ids = data['ids']
+        for i in range(len(paths)):
+            path_id_map[paths[i]] = ids[i]
+        # Instancating the OCR clustering
+        clustering_ocr = ClusteringOCR(verbose=True)
+
+        # Running the clustering
+        clustering_start_time = time.time()
+        number_shards = 1
+        if len(ocr_results) >= SHARDED_CLUSTERING_MIN_IMAGES:
+            number_shards = os.cpu_count() or 1
+        most_common_text_per_index, clustering_output = clustering_ocr.run(
+            ocr_results,
+            paths,
+            reference_indexes=[],
+            bbox_threshold=BBOX_DISTANCE_THRESHOLD,
+            number_shards=number_shards,
+        )
+        if stream:
+            emit_event(
+                "progress",
+                stage="clustering",
+                framesDone=len(ocr_results),
+                totalFrames=len(paths),
+                batchFrames=len(ocr_results),
+                batchSeconds=round(time.time() - clustering_start_time, 3),
+            )
+
+        #  Displaying the result
+        reference_string = combine_string_from_dict(most_common_text_per_index)
+        anomaly_images = []
+
+        for image_name, anomalies in clustering_output:
+            ind = anomalies[0][0]
+            ocr_text = ocr_results.get_texts(ind)
+            if len(ocr_text) == 0 or not is_similar(
+                reference_string, combine_string_from_array(ocr_text)
+            ):
+                anomaly_set.add(image_name)
+                anomaly_images.append(image_name)
+            else:
+                clustered_set.add(image_name)
+
+        # the anomalies are only known once the whole reel is clustered.
+        # The flagged images are sent in chunks to keep every event small enough for a SQS message
+        if stream:
+            for i in range(0, len(anomaly_images), PROGRESS_BATCH_SIZE):
+                emit_event(
+                    "anomalies",
+                    anomalyCount=len(anomaly_set),
+                    newAnomalyImages=[
+                        {"id": path_id_map[path], "path": path}
+                        for path in anomaly_images[i : i + PROGRESS_BATCH_SIZE]
+                    ],
+                )
+    except Exception as e:
+        has_error = True
+        saved_exception = e
+        pass
+
+    # TODO: handle more logic here and think about how we can cluster it together, and what response we want from this API
+    output = {
+        "clusteredImages": [{"id": path_id_map[i], "path": i} for i in list(clustered_set)],
+        "anomalyImages": [{"id": path_id_map[i], "path": i} for i in list(anomaly_set)],
+        "hasError": has_error,
+    }
+    print(json.dumps(output))
+    if has_error:
+        raise saved_exception
+
+
+if __name__ == "__main__":
+    main(sys.argv)